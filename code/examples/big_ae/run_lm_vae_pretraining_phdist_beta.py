@@ -24,32 +24,39 @@ from __future__ import absolute_import, division, print_function
 
 import pdb
 import argparse
+import contextlib
+import copy
+import functools
 import glob
 import logging
 
 import os, sys
 import pickle
+import queue
 import random
-from pathlib import Path
 import os.path as op
 import time, json
-from io import open
+from io import open, BytesIO
 import re
+import threading
+import warnings
 
 import numpy as np
 import torch
+from torch.optim import AdamW
 from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from tensorboardX import SummaryWriter
 from tqdm import tqdm, trange
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 
 import torch.nn.init as init
 
 # from azure.cosmosdb.table.tableservice import TableService
 # from azure.cosmosdb.table.models import Entity
-from datetime import datetime
+from datetime import datetime, timedelta
 
 try:
     this_file = __file__
@@ -61,7 +68,7 @@ print('current folder: {}'.format(op.dirname(this_file)))
 sys.path.insert(0, op.join(op.dirname(this_file), '../..'))
 
 
-from pytorch_transformers import (WEIGHTS_NAME, AdamW, WarmupLinearSchedule,
+from pytorch_transformers import (WEIGHTS_NAME, WarmupLinearSchedule,
                                   BertConfig, BertForLatentConnector, BertTokenizer,
                                   GPT2Config, GPT2ForLatentConnector, GPT2Tokenizer,
                                   OpenAIGPTConfig, OpenAIGPTLMHeadModel, OpenAIGPTTokenizer,
@@ -177,7 +184,9 @@ def build_dataload_and_cache_examples(args, tokenizer, evaluate=False):
     if isinstance(tokenizer, list):
         args.batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
         file_path=args.train_data_file
-        dataloader = BucketingMultipleFiles_DataLoader(file_path, args.batch_size, args.max_seq_length, tokenizer, args, bucket=100, shuffle=True)
+        dataloader = BucketingMultipleFiles_DataLoader(file_path, args.batch_size, args.max_seq_length, tokenizer, args, bucket=100, shuffle=True,
+                                                       world_size=ompi_size(), rank=args.local_rank, worker_init_fn=functools.partial(seed_worker, args.seed),
+                                                       memmap_cache_dir=args.memmap_cache_dir, num_workers=args.num_workers)
     else:
         pass 
     return dataloader
@@ -191,6 +200,31 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
+def seed_worker(seed, worker_id):
+    """ Seed a DataLoader worker process; the main process is seeded once in main(). """
+    random.seed(seed + worker_id)
+    np.random.seed(seed + worker_id)
+    torch.manual_seed(seed + worker_id)
+
+
+def batches_to_device(batches, device, copy_stream=None):
+    """ Yield the token tensors of each batch on `device`. The host-to-device copies are issued on `copy_stream`, so
+    the next batch is transferred while the kernels queued for the current one are still running. """
+    for tokenized_text0, tokenized_text1, tokenized_text_lengths in batches:
+        if copy_stream is None:
+            yield tokenized_text0.to(device, non_blocking=True), tokenized_text1.to(device, non_blocking=True), tokenized_text_lengths
+            continue
+        with torch.cuda.stream(copy_stream):
+            tokenized_text0 = tokenized_text0.to(device, non_blocking=True)
+            tokenized_text1 = tokenized_text1.to(device, non_blocking=True)
+        compute_stream = torch.cuda.current_stream(device)
+        compute_stream.wait_stream(copy_stream)
+        # The tensors were allocated on the copy stream; keep the allocator from reusing them while compute still reads them
+        tokenized_text0.record_stream(compute_stream)
+        tokenized_text1.record_stream(compute_stream)
+        yield tokenized_text0, tokenized_text1, tokenized_text_lengths
+
+
 def weights_init_rondom(model):
     model = model.module if hasattr(model, 'module') else model  # Take care of distributed/parallel training
     model_state_dict = model.state_dict()
@@ -198,29 +232,67 @@ def weights_init_rondom(model):
         init.normal_(model_state_dict[key].data)  
 
 
-def mask_tokens(inputs, tokenizer, args):
+def mask_tokens(inputs, mask_token_id, vocab_size, args):
     """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
     labels = inputs.clone()
     # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-    
-    masked_indices = torch.bernoulli(torch.full(labels.shape, args.mlm_probability)).to(torch.uint8)
-    labels[masked_indices==1] = -1  # We only compute loss on masked tokens
+    # A single uniform draw decides both whether a token is masked and how: [0, 0.8p) -> [MASK], [0.8p, 0.9p) -> random word, [0.9p, p) -> unchanged
+    probs = torch.rand(labels.shape, device=inputs.device)
+    masked_indices = probs < args.mlm_probability
+    labels.masked_fill_(masked_indices, -1)  # We only compute loss on masked tokens
 
-    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).to(torch.uint8) & masked_indices
-    inputs[indices_replaced] = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
+    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK]), whose id is resolved once by the caller
+    indices_replaced = probs < 0.8 * args.mlm_probability
+    inputs.masked_fill_(indices_replaced, mask_token_id)
 
     # 10% of the time, we replace masked input tokens with random word
-    indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).to(torch.uint8) & masked_indices & ~indices_replaced
-    indices_random = indices_random
-    random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long)
-    inputs[indices_random] = random_words[indices_random]
+    indices_random = (probs >= 0.8 * args.mlm_probability) & (probs < 0.9 * args.mlm_probability)
+    random_positions = indices_random.nonzero(as_tuple=True)
+    # Token ids fit in int32; widen to the input dtype only for the scatter
+    random_words = torch.randint(vocab_size, (random_positions[0].numel(),), dtype=torch.int32, device=inputs.device)
+    inputs.index_put_(random_positions, random_words.to(inputs.dtype))
 
     # The rest of the time (10% of the time) we keep the masked input tokens unchanged
     return inputs, labels
 
 
 
+def mask_padded_logits(vocab_size, module, inputs, logits):
+    """ Forward hook for an LM head padded past the tokenizer: the padded ids get -inf logits and are never predicted. """
+    # In place on the padded columns only, no full-size copy; safe because Linear's backward does not need its output
+    logits[..., vocab_size:].fill_(float('-inf'))
+    return logits
+
+
+def unpad_decoder_vocab(model_state_dict, vocab_size):
+    """ Trim the padded vocabulary rows from a VAE state dict, so it loads into a decoder sized to the tokenizer. """
+    for key in ['decoder.transformer.wte.weight', 'decoder.lm_head.weight']:
+        if key in model_state_dict:
+            # clone() so torch.save writes only the kept rows, not the whole storage
+            model_state_dict[key] = model_state_dict[key][:vocab_size].clone()
+    return model_state_dict
+
+
+def state_to_cpu(state):
+    """ Recursively copy the tensors of a (nested) state dict into host memory. """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        state_cpu = type(state)((k, state_to_cpu(v)) for k, v in state.items())
+        if hasattr(state, '_metadata'):
+            state_cpu._metadata = state._metadata
+        return state_cpu
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
+# Full checkpoints are serialized on a background thread so training is not blocked on disk IO
+_checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+_pending_checkpoint = None
+CHECKPOINT_WRITE_CHUNK_SIZE = 64 * 1024 * 1024
+
+
 def save_checkpoint(model_vae, optimizer, global_step, args):
 
     # Create output directory if needed
@@ -272,41 +344,99 @@ def save_checkpoint(model_vae, optimizer, global_step, args):
     # save the full model and optmizer into a checkpoint
     model_to_save = model_vae.module if hasattr(model_vae, 'module') else model_vae  # Take care of distributed/parallel training
 
+    # Snapshot the states on the host so training can keep updating the live tensors while the file is written
+    model_state_dict = state_to_cpu(model_to_save.state_dict())
+    if args.pad_vocab_multiple > 0:
+        model_state_dict = unpad_decoder_vocab(model_state_dict, args.decoder_vocab_size)
     checkpoint = {
     'iter': global_step,
-    'model_state_dict': model_to_save.state_dict(),
-    'optimizer_state_dict': optimizer.state_dict(),
+    'model_state_dict': model_state_dict,
+    'optimizer_state_dict': state_to_cpu(optimizer.state_dict()),
     'beta': model_to_save.args.beta,
-    'args': args
+    'args': copy.copy(args)
     }
 
     output_full_dir = os.path.join(args.output_dir, 'checkpoint-full-{}'.format(global_step))
     if not os.path.exists(output_full_dir) and args.local_rank in [-1, 0]:
         os.makedirs(output_full_dir)
 
+    # At most one full checkpoint is in flight: wait for the previous write before queueing this one
+    global _pending_checkpoint
+    wait_for_checkpoint()
     logger.info("Start saving full model checkpoint to %s", output_full_dir)
-    if args.use_philly:
+    _pending_checkpoint = _checkpoint_executor.submit(write_full_checkpoint, checkpoint, output_full_dir, args.use_philly)
+
+
+def write_full_checkpoint(checkpoint, output_full_dir, use_philly):
+    # Serialize once up front; Philly retries only repeat the file write, not the pickling
+    buffer = BytesIO()
+    torch.save(checkpoint, buffer)
+    output_file = os.path.join(output_full_dir, 'training.bin')
+
+    if use_philly:
         save_solid = False
         n_save_attempts = 0
         while not save_solid:
             try:
                 n_save_attempts += 1
                 logger.info(f"Saving full checkpoint: {n_save_attempts} attempts made")
-                torch.save(checkpoint, os.path.join(output_full_dir, 'training.bin'))
+                write_bytes_chunked(buffer.getbuffer(), output_file)
                 logger.info("Saving full checkpoint to %s,", output_full_dir)
                 save_solid = True
             except:
                 pass
     else:
-        torch.save(checkpoint, os.path.join(output_full_dir, 'training.bin'))
+        write_bytes_chunked(buffer.getbuffer(), output_file)
         logger.info("Saving full checkpoint to %s", output_full_dir)
 
 
+def write_bytes_chunked(data, output_file, chunk_size=CHECKPOINT_WRITE_CHUNK_SIZE):
+    """ Write a serialized blob with large unbuffered writes instead of many small pickler writes. """
+    view = memoryview(data)
+    with open(output_file, 'wb', buffering=0) as f:
+        while view:
+            n_written = f.write(view[:chunk_size])
+            view = view[n_written:]
+
+
+def wait_for_checkpoint():
+    """ Block until the full checkpoint queued by save_checkpoint (if any) is on disk. """
+    global _pending_checkpoint
+    if _pending_checkpoint is not None:
+        _pending_checkpoint.result()
+        _pending_checkpoint = None
+
+
+class AsyncSummaryWriter(object):
+    """ Forward add_scalar calls to a SummaryWriter from a daemon thread so logging does not block the training step. """
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.writer.add_scalar(*item)
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        self.queue.put((tag, scalar_value, global_step))
+
+    def close(self):
+        # Drain the pending scalars before closing the underlying writer
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+
+
 def train(args, train_dataloader, model_vae, encoder_tokenizer, decoder_tokenizer, table_name):
     """ Train the model """
     #gpus = list(gpu_indices())
 
-    if args.local_rank in [-1, 0]: tb_writer = SummaryWriter()
+    if args.local_rank in [-1, 0]: tb_writer = AsyncSummaryWriter(SummaryWriter())
 
 
     args.n_gpu = (torch.distributed.get_world_size() if args.local_rank != -1 else 1)
@@ -327,35 +457,44 @@ def train(args, train_dataloader, model_vae, encoder_tokenizer, decoder_tokenize
 
 
     # model_encoder, model_decoder, model_connector = model_vae.encoder,  model_vae.decoder, model_vae.linear
-    no_decay = ['bias', 'LayerNorm.weight']
+    no_decay = ('bias', 'LayerNorm.weight')
+    decay_params, no_decay_params = [], []
+    for n, p in model_vae.named_parameters():
+        (no_decay_params if n.endswith(no_decay) else decay_params).append(p)
     optimizer_grouped_parameters = [
-        {'params': [p for n, p in model_vae.named_parameters() if not any(nd in n for nd in no_decay)], 'weight_decay': args.weight_decay},
-        {'params': [p for n, p in model_vae.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+        {'params': decay_params, 'weight_decay': args.weight_decay},
+        {'params': no_decay_params, 'weight_decay': 0.0}
         ]
+    # Reused for gradient clipping so the module tree is not walked again on every step
+    params_to_clip = decay_params + no_decay_params
     
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
+    # torch.optim.AdamW applies the same decoupled weight decay and bias correction as the pytorch_transformers AdamW, but adds eps
+    # after bias-correcting sqrt(v) rather than before, so the first steps differ slightly. It updates all tensors with
+    # multi-tensor kernels; --fused_adam goes further and runs the whole update as a single CUDA kernel
+    adamw_impl = {'fused': True} if args.fused_adam and args.device.type == 'cuda' else {'foreach': True}
+    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon, **adamw_impl)
     scheduler = WarmupLinearSchedule(optimizer, warmup_steps=args.warmup_steps, t_total=t_total)
 
 
-    if args.fp16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-        model_vae, optimizer = amp.initialize(model_vae, optimizer, opt_level=args.fp16_opt_level)
+    # Native mixed precision: fp16 needs loss scaling, bf16 has the fp32 exponent range and runs without a scaler.
+    # With the scaler disabled, scale/unscale_/step/update are pass-throughs, so the step loop has a single code path.
+    use_autocast = args.fp16 or args.bf16
+    autocast_dtype = torch.bfloat16 if args.bf16 else torch.float16
+    scaler = torch.amp.GradScaler('cuda', enabled=args.fp16 and not args.bf16)
 
-    # multi-gpu training (should be after apex fp16 initialization)
+    # multi-gpu training
     #if args.n_gpu > 1:
     #    model_vae = torch.nn.DataParallel(model_vae, device_ids=range(args.n_gpu)).to(args.device)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     #if args.local_rank != -1:
         #model_vae = torch.nn.parallel.DistributedDataParallel(model_vae, device_ids=gpus, output_device=args.local_rank, find_unused_parameters=True)
         #model_vae = torch.nn.parallel.DistributedDataParallel(model_vae, device_ids=gpus)
 
 
-    files = Path(args.train_data_file)
-    num_files = len(list(files.glob('*seq64*.json')))
+    # A single directory listing; scandir reads names from the dirents without building Path objects
+    with os.scandir(args.train_data_file) as entries:
+        num_files = sum(1 for entry in entries if 'seq64' in entry.name and entry.name.endswith('.json'))
 
 
     # Train!
@@ -371,9 +510,10 @@ def train(args, train_dataloader, model_vae, encoder_tokenizer, decoder_tokenize
 
 
     global_step = 0
-    tr_loss, logging_loss = 0.0, 0.0
+    # Running loss stays on the device; it is only synced to the host when logged
+    tr_loss, logging_loss = torch.zeros((), device=args.device), torch.zeros((), device=args.device)
 
-    model_vae.zero_grad()
+    model_vae.zero_grad(set_to_none=True)
     num_train_epochs_iterator = trange(int(args.num_train_epochs), desc="Epoch") #, disable=args.local_rank not in [-1, 0])
 
     #n_iter = int(args.num_train_epochs) * len(train_dataloader)
@@ -381,41 +521,50 @@ def train(args, train_dataloader, model_vae, encoder_tokenizer, decoder_tokenize
     n_iter = int(args.num_train_epochs * n_iter_per_file * num_files)
     beta_t_list = frange_cycle_zero_linear(n_iter, start=0.0, stop=args.beta, n_cycle=10,  ratio_increase=args.ratio_increase, ratio_zero=args.ratio_zero)
     logger.info(f"Total iters (estimated): {n_iter}; Length of beta schedule: {len(beta_t_list)}; #Iter per file {n_iter_per_file}")
+    # Steps past the end of the schedule use beta = 1.0; pad once so the step loop is a clamped lookup.
+    # Kept as Python floats: the KL weight is passed to the kernel as a scalar argument, with no numpy dispatch or device sync.
+    beta_t_list = np.append(beta_t_list, 1.0).tolist()
+    last_beta_idx = len(beta_t_list) - 1
+
+    # Resolved once here rather than by mask_tokens on every batch
+    mask_token_id = encoder_tokenizer.convert_tokens_to_ids(encoder_tokenizer.mask_token)
+    encoder_vocab_size = len(encoder_tokenizer)
+
+    # The VAE reads beta / fb_mode from its args on every forward; bind them once instead of going through DDP's .module each step
+    vae_args = (model_vae.module if hasattr(model_vae, 'module') else model_vae).args
+
+    accumulate_grad = args.gradient_accumulation_steps > 1
+    last_save_time = time.time()
+
+    # Side stream for input copies, created once; kept off args because args is pickled into every checkpoint
+    copy_stream = torch.cuda.Stream(device=args.device) if args.device.type == 'cuda' else None
 
     beta_t = 0.0
     tmp_list = []
     dict_token_length = defaultdict(int)
 
-    set_seed(args)  # Added here for reproducibility (even between python 2 and 3)
     for epoch in range(int(args.num_train_epochs)): # num_train_epochs_iterator:
         train_dataloader.reset()
         for idx_file in range(num_files-1):
 
-            logger.info(f"Rank {ompi_rank()}, Epoch {epoch}, File idx {train_dataloader.file_idx}")
+            logger.info("Rank %s, Epoch %s, File idx %s", args.local_rank, epoch, train_dataloader.file_idx)
             #epoch_iterator = tqdm(train_dataloader, desc="Iteration") #disable=disable=args.local_rank not in [-1, 0])
-            for step, batch in enumerate(train_dataloader):
+            # Batches come from pinned memory and are copied on the side stream, overlapping with the previous step's compute
+            for step, batch in enumerate(batches_to_device(train_dataloader, args.device, copy_stream)):
                 tokenized_text0, tokenized_text1, tokenized_text_lengths = batch
                 
                 #dict_token_length[tokenized_text_lengths[0,0].item()] += 1
                 # continue
-                # tokenized_text0 = tokenized_text0.to(args.device)
-                # tokenized_text1 = tokenized_text1.to(args.device)
                 # prepare input-output data for reconstruction
 
-                inputs, labels = mask_tokens(tokenized_text0, encoder_tokenizer, args) if args.mlm else (tokenized_text0, tokenized_text1)
+                inputs, labels = mask_tokens(tokenized_text0, mask_token_id, encoder_vocab_size, args) if args.mlm else (tokenized_text0, tokenized_text1)
+                # The decoder always reconstructs the GPT-2 tokens
                 labels = tokenized_text1
 
-                tokenized_text1 = tokenized_text1.to(args.device)
-                inputs = inputs.to(args.device)
-                labels = labels.to(args.device)
-
                 model_vae.train()
 
                 if args.use_beta_schedule:
-                    if global_step >= len(beta_t_list):
-                        beta_t = 1.0
-                    else:
-                        beta_t = beta_t_list[global_step]
+                    beta_t = beta_t_list[min(global_step, last_beta_idx)]
 
                     #try:
                     #    beta_t = beta_t_list[global_step] #[step + idx_file* n_iter_per_file]
@@ -423,49 +572,46 @@ def train(args, train_dataloader, model_vae, encoder_tokenizer, decoder_tokenize
                     #    beta_t = 0.0
 
                 #beta_t = 0.0 # beta_t_list[step +  epoch*len(epoch_iterator)]
-                model_vae.module.args.beta = beta_t
-
-                if beta_t == 0.0:
-                    model_vae.module.args.fb_mode = 0
-                else:
-                    model_vae.module.args.fb_mode = 1
-                
-                if args.use_deterministic_connect:
-                    model_vae.module.args.fb_mode = 2
-
-                loss_rec, loss_kl, loss = model_vae(inputs, labels)
-
-                loss_rec = loss_rec.mean()  # mean() to average on multi-gpu parallel training
-                loss_kl = loss_kl.mean()
-                loss = loss.mean()
-
-                if args.use_philly:
-                    #if args.local_rank in [-1, 0]:
-                    if args.logging_steps > 0 and global_step % args.logging_steps == 0:
-                        logger.info("Steps {}, Rank {}, File {}, Epoch: [{}/{}][{}/{}], Beta: {}, Loss: {}".format(global_step, ompi_rank(), train_dataloader.file_idx,
-                                    epoch, args.num_train_epochs, step, n_iter_per_file, model_vae.module.args.beta, loss_rec))
-                        logger.info("PROGRESS: {}%".format(round(100 * global_step /n_iter, 4)))
-                        logger.info("EVALERR: {}%".format(loss_rec))
-
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
-
-                if args.fp16:
-                    with amp.scale_loss(loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()                                   
-                else:
-                    loss.backward()
-
-                tr_loss += loss.item()
-                if (step + 1) % args.gradient_accumulation_steps == 0:
-                    if args.fp16:
-                        torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                    else:
-                        torch.nn.utils.clip_grad_norm_(model_vae.parameters(), args.max_grad_norm)
-
-                    optimizer.step()
+                vae_args.beta = beta_t
+                vae_args.fb_mode = 2 if args.use_deterministic_connect else int(beta_t > 0.0)
+
+                sync_gradients = (step + 1) % args.gradient_accumulation_steps == 0
+                # Skip DDP's gradient all-reduce on accumulation steps that are not followed by an optimizer step
+                grad_sync_context = model_vae.no_sync() if accumulate_grad and not sync_gradients and hasattr(model_vae, 'no_sync') else contextlib.nullcontext()
+                if args.cuda_graph:
+                    # Each micro-batch is a new step for the graph trees, so replays may reuse the previous step's output buffers
+                    torch.compiler.cudagraph_mark_step_begin()
+                with grad_sync_context:
+                    with torch.autocast(device_type=args.device.type, dtype=autocast_dtype, enabled=use_autocast):
+                        loss_rec, loss_kl, loss = model_vae(inputs, labels)
+
+                    loss_rec = loss_rec.mean()  # mean() to average on multi-gpu parallel training
+                    loss_kl = loss_kl.mean()
+                    loss = loss.mean()
+
+                    if args.use_philly:
+                        #if args.local_rank in [-1, 0]:
+                        if args.logging_steps > 0 and global_step % args.logging_steps == 0:
+                            # %-style arguments: the loss tensors are only formatted (and synced to the host) where the record is emitted
+                            logger.info("Steps %s, Rank %s, File %s, Epoch: [%s/%s][%s/%s], Beta: %s, Loss: %s", global_step, args.local_rank, train_dataloader.file_idx,
+                                        epoch, args.num_train_epochs, step, n_iter_per_file, vae_args.beta, loss_rec)
+                            logger.info("PROGRESS: %s%%", round(100 * global_step /n_iter, 4))
+                            logger.info("EVALERR: %s%%", loss_rec)
+
+                    if accumulate_grad:
+                        loss = loss / args.gradient_accumulation_steps
+
+                    scaler.scale(loss).backward()
+
+                tr_loss += loss.detach()
+                if sync_gradients:
+                    scaler.unscale_(optimizer)  # Clip the true gradients, not the loss-scaled ones
+                    torch.nn.utils.clip_grad_norm_(params_to_clip, args.max_grad_norm, foreach=True)
+
+                    scaler.step(optimizer)
+                    scaler.update()
                     scheduler.step()  # Update learning rate schedule
-                    model_vae.zero_grad()
+                    model_vae.zero_grad(set_to_none=True)  # Release the grads instead of memset-ing them; backward re-creates them
 
                     global_step += 1
 
@@ -476,11 +622,13 @@ def train(args, train_dataloader, model_vae, encoder_tokenizer, decoder_tokenize
                             for key, value in results.items():
                                 tb_writer.add_scalar('eval_{}'.format(key), value, global_step)
                         tb_writer.add_scalar('lr', scheduler.get_lr()[0], global_step)
-                        tb_writer.add_scalar('loss', (tr_loss - logging_loss)/args.logging_steps, global_step)
-                        logging_loss = tr_loss
+                        tb_writer.add_scalar('loss', ((tr_loss - logging_loss)/args.logging_steps).item(), global_step)
+                        logging_loss = tr_loss.clone()
 
-                    if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
+                    if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0 \
+                            and time.time() - last_save_time >= args.save_min_interval_secs:
                         save_checkpoint(model_vae, optimizer, global_step, args)
+                        last_save_time = time.time()
        
 
                 if args.max_steps > 0 and global_step > args.max_steps:
@@ -493,10 +641,22 @@ def train(args, train_dataloader, model_vae, encoder_tokenizer, decoder_tokenize
     # with open('wikipedia_stats.json', 'w') as fp:
     #     json.dump(dict_token_length, fp)
 
-    return global_step, tr_loss / global_step, optimizer
+    if args.local_rank in [-1, 0]: tb_writer.close()
+
+    return global_step, tr_loss.item() / global_step, optimizer
 
 
 def main():
+    # Sequence lengths vary per bucket, so let the caching allocator grow segments instead of fragmenting fixed blocks.
+    # Read when CUDA initializes, so it has to be set before the first torch.cuda call; an existing setting wins.
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+    # NCCL defaults shared by all ranks, set before the process group exists; values from the launcher take precedence.
+    # Async error handling tears down a rank whose collective failed instead of hanging; when IB is unavailable, open
+    # more sockets/threads per peer for the TCP all-reduce. NIC selection is left to NCCL, which already skips lo/docker*.
+    os.environ.setdefault('TORCH_NCCL_ASYNC_ERROR_HANDLING', '1')
+    os.environ.setdefault('NCCL_NSOCKS_PERTHREAD', '4')
+    os.environ.setdefault('NCCL_SOCKET_NTHREADS', '2')
+
     parser = argparse.ArgumentParser()
 
     ## Required parameters
@@ -537,6 +697,9 @@ def main():
     parser.add_argument("--use_deterministic_connect", action='store_true',
                         help="Use deterministic inference to generate latent codes, i.e., standard auto-encoders.")
     parser.add_argument("--use_beta_schedule", action='store_true', help="Use cyclical beta schedule for auto-encoders.")
+    parser.add_argument("--pad_vocab_multiple", default=0, type=int,
+                        help="Pad the decoder vocabulary to a multiple of this (e.g. 64) for tensor-core aligned LM-head GEMMs. "
+                             "The padded logits are masked and the padded rows are left out of checkpoint-full-*. 0 disables padding.")
 
     ## Objective functions
     parser.add_argument("--mlm", action='store_true',
@@ -588,6 +751,8 @@ def main():
                         help="Weight deay if we apply some.")
     parser.add_argument("--adam_epsilon", default=1e-8, type=float,
                         help="Epsilon for Adam optimizer.")
+    parser.add_argument("--fused_adam", action='store_true',
+                        help="Use the fused single-kernel CUDA implementation of AdamW.")
     parser.add_argument("--max_grad_norm", default=1.0, type=float,
                         help="Max gradient norm.")
     parser.add_argument("--num_train_epochs", default=1.0, type=float,
@@ -602,8 +767,10 @@ def main():
     ## IO: Logging and Saving
     parser.add_argument('--logging_steps', type=int, default=50,
                         help="Log every X updates steps.")
-    parser.add_argument('--save_steps', type=int, default=50,
+    parser.add_argument('--save_steps', type=int, default=2000,
                         help="Save checkpoint every X updates steps.")
+    parser.add_argument('--save_min_interval_secs', type=float, default=600,
+                        help="Skip a periodic checkpoint if the previous one was saved less than this many seconds ago.")
     parser.add_argument("--eval_all_checkpoints", action='store_true',
                         help="Evaluate all checkpoints starting with the same prefix as model_name_or_path ending and ending with step number")
     parser.add_argument("--no_cuda", action='store_true',
@@ -612,6 +779,11 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--memmap_cache_dir', default=None, type=str,
+                        help="Convert each training shard once into memory-mapped token arrays under this directory and train from those "
+                             "instead of the JSON files. Rank 0 builds the cache, so it must be shared by all ranks. Off when not given.")
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help="DataLoader worker processes per rank")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--gloabl_step_eval', type=int, default=661,
@@ -619,34 +791,50 @@ def main():
 
     # Precision & Distributed Training 
     parser.add_argument('--fp16', action='store_true',
-                        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit")
-    parser.add_argument('--fp16_opt_level', type=str, default='O1',
-                        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-                             "See details at https://nvidia.github.io/apex/amp.html")
+                        help="Whether to use 16-bit (mixed) precision (through torch.autocast and torch.amp.GradScaler) instead of 32-bit")
+    parser.add_argument('--grad_checkpoint', action='store_true',
+                        help="Recompute encoder/decoder layer activations in the backward pass to save memory (allows larger batches)")
+    parser.add_argument('--no_compile', action='store_true',
+                        help="Run the encoder/decoder eagerly instead of through torch.compile (for debugging)")
+    parser.add_argument('--cuda_graph', action='store_true',
+                        help="Compile the encoder/decoder with mode='reduce-overhead', replaying CUDA graphs recorded per sequence length")
+    parser.add_argument('--bf16', action='store_true',
+                        help="Use bfloat16 autocast (Ampere or newer GPUs) instead of 32-bit; no loss scaling is needed")
+    parser.add_argument('--fp16_opt_level', type=str, default=None,
+                        help="Deprecated and ignored: --fp16 uses native torch.autocast mixed precision, which has no optimization levels.")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
     parser.add_argument('--server_ip', type=str, default='', help="For distant debugging.")
     parser.add_argument('--server_port', type=str, default='', help="For distant debugging.")
 
     parser.add_argument('--world-size', default=ompi_size(), type=int, help='number of distributed processes')
-    parser.add_argument('--dist-url', default='tcp://' + get_master_ip() + ':23456', type=str,
-                        help='url used to set up distributed training')
-    parser.add_argument('--dist-backend', default='nccl', type=str, help='distributed backend')
+    parser.add_argument('--dist-url', default=None, type=str,
+                        help='Ignored: ranks rendezvous through a TCPStore on the master ip (from ~/mpi-hosts) and --port')
+    parser.add_argument('--dist-backend', default='cuda:nccl,cpu:gloo', type=str,
+                        help='distributed backend; the default runs collectives on CPU tensors over gloo instead of bouncing them through the GPU')
     parser.add_argument('--port', type=str, default='51115', help="Port")
 
     args = parser.parse_args()
 
-    args.dist_url = 'tcp://' + get_master_ip() + ':' + args.port
+    # Look the rank and master address up once; everything below reuses them
+    rank_node = ompi_rank()
+    master_ip = get_master_ip()
+
+    # Let fp32 matmuls/convolutions outside autocast use TF32 tensor cores
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cudnn.allow_tf32 = True
 
     # Setup logging
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                         datefmt='%m/%d/%Y %H:%M:%S',
                         level=logging.INFO)
     logger = logging.getLogger(__name__)
+    if rank_node != 0:
+        # Only rank 0 reports progress; the other ranks still surface errors
+        logger.setLevel(logging.ERROR)
 
-    rank_node = ompi_rank()
     args.distributed = args.world_size > 1
-    logger.info("Rank {} distributed: {}".format(rank_node, args.distributed))
+    logger.info("Rank %s distributed: %s", rank_node, args.distributed)
 
     if args.decoder_model_type in ["bert", "roberta"] and not args.mlm:
         raise ValueError("BERT and RoBERTa do not have LM heads but masked LM heads. They must be run using the --mlm "
@@ -654,6 +842,10 @@ def main():
     if args.eval_data_file is None and args.do_eval:
         raise ValueError("Cannot do evaluation without an evaluation data file. Either supply a file to --eval_data_file "
                          "or remove the --do_eval argument.")
+    if args.fp16_opt_level is not None:
+        warnings.warn("--fp16_opt_level is deprecated and ignored; --fp16 uses native torch.autocast mixed precision.", DeprecationWarning)
+    if args.fp16 and not torch.cuda.is_available():
+        raise RuntimeError("--fp16 requires CUDA")
 
     if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and args.do_train and not args.overwrite_output_dir:
         raise ValueError("Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(args.output_dir))
@@ -666,34 +858,45 @@ def main():
         ptvsd.enable_attach(address=(args.server_ip, args.server_port), redirect_output=True)
         ptvsd.wait_for_attach()
 
-    if args.distributed:  # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-        torch.distributed.init_process_group(
-            backend=args.dist_backend,
-            init_method=args.dist_url,
-            world_size=args.world_size,
-            rank=ompi_rank(),
-            group_name='mtorch')
-        logger.info("World Size is {}, Backend is {}, Init Method is {}, rank is {}".format(args.world_size, args.dist_backend, args.dist_url, ompi_rank()))
-
+    # Bind this process to its GPU before creating the process group; NCCL can hang when the current device is unset at init
     gpus = list(gpu_indices())
     args.n_gpu = len(gpus)
-    args.local_rank = ompi_rank() #gpus[0]
+    # Each process drives exactly one GPU (DDP is pinned to gpus[0]); with more, the per-process batch would be scaled by
+    # n_gpu while the extra GPUs sat idle. This also covers distributed runs with fewer ranks per node than GPUs.
+    if args.n_gpu > 1:
+        raise ValueError("{} GPUs are assigned to this process; DataParallel is not supported. Relaunch with one process per GPU, "
+                         "e.g. `mpirun -np {} python {} ...`.".format(args.n_gpu, args.n_gpu * args.world_size, op.basename(this_file)))
+    args.local_rank = rank_node #gpus[0]
     torch.cuda.set_device(gpus[0])
     device = torch.device("cuda", gpus[0])
 
+    if args.distributed and not torch.distributed.is_initialized():  # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
+        # Rank 0 hosts the rendezvous store and the other ranks connect to it, instead of every rank racing through a tcp:// init_method
+        store = torch.distributed.TCPStore(master_ip, int(args.port), world_size=args.world_size, is_master=(rank_node == 0),
+                                           timeout=timedelta(seconds=1800))
+        torch.distributed.init_process_group(
+            backend=args.dist_backend,
+            store=store,
+            world_size=args.world_size,
+            rank=rank_node,
+            group_name='mtorch',
+            device_id=device)
+        logger.info("World Size is %s, Backend is %s, Store is %s:%s, rank is %s", args.world_size, args.dist_backend, master_ip, args.port, rank_node)
+
     args.device = device
-    logger.info('Rank {}, gpus: {}, get_rank: {}'.format(rank_node, gpus, torch.distributed.get_rank()))
-    logger.info(f'Local rank is {args.local_rank}, {rank_node}')
+    logger.info('Rank %s, gpus: %s, get_rank: %s', rank_node, gpus, torch.distributed.get_rank())
+    logger.info('Local rank is %s, %s', args.local_rank, rank_node)
 
     logger.warning("Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s", args.local_rank, device, args.n_gpu, bool(args.local_rank != -1), args.fp16)
 
     args.ExpName = 'Vae_' + args.dataset + '_Nz_' + str(args.latent_size) + '_Beta_'  + str(args.beta) + '_Dkl_' + str(args.dim_target_kl) + '_Ra_' + str(args.ratio_increase) + '_R0_' + str(args.ratio_zero)
     table_name = 'Vae' + args.dataset + 'Nz' + str(args.latent_size) 
-    if ompi_rank() == 0:
+    # Both names are derived from the parsed args, so every rank already agrees on them; only rank 0 touches the table service
+    if rank_node == 0:
         try:
             ts.create_table(table_name)
-        except:
-            pass
+        except Exception as e:
+            logger.warning("create_table failed: %s", e)
 
 
     # Set seed
@@ -710,7 +913,8 @@ def main():
         args.block_size = tokenizer_encoder.max_len_single_sentence  # Our input block size will be the max possible for the model
     args.block_size = min(args.block_size, tokenizer_encoder.max_len_single_sentence)
     model_encoder = encoder_model_class.from_pretrained(args.encoder_model_name_or_path, from_tf=bool('.ckpt' in args.encoder_model_name_or_path), config=encoder_config, latent_size=args.latent_size)
-    # model_encoder.to(args.device)
+    # Move each model to the GPU as soon as it is loaded, so the host holds only one set of pretrained weights at a time
+    model_encoder.to(args.device)
 
     ## Decoder 
     decoder_config_class, decoder_model_class, decoder_tokenizer_class = MODEL_CLASSES[args.decoder_model_type]
@@ -721,27 +925,52 @@ def main():
     args.block_size = min(args.block_size, tokenizer_decoder.max_len_single_sentence)
     setattr(decoder_config, "latent_size", args.latent_size)
     model_decoder = decoder_model_class.from_pretrained(args.decoder_model_name_or_path, from_tf=bool('.ckpt' in args.decoder_model_name_or_path), config=decoder_config, latent_size=args.latent_size)
+    model_decoder.to(args.device)  # Before resize_token_embeddings, so the resized embedding lives on the GPU too
     
     # Chunyuan: Add Padding token to GPT2
     special_tokens_dict = {'pad_token': '<PAD>', 'bos_token': '<BOS>', 'eos_token': '<EOS>'}
     num_added_toks = tokenizer_decoder.add_special_tokens(special_tokens_dict)
     print('We have added', num_added_toks, 'tokens to GPT2')
-    model_decoder.resize_token_embeddings(len(tokenizer_decoder))  # Notice: resize_token_embeddings expect to receive the full size of the new vocabulary, i.e. the length of the tokenizer.
+    args.decoder_vocab_size = len(tokenizer_decoder)
+    if args.pad_vocab_multiple > 0:
+        # Tensor-core friendly LM-head GEMM shapes; the padded logits are masked to -inf so those ids are never predicted,
+        # and save_checkpoint trims the padded rows so checkpoints keep the tokenizer-sized vocabulary
+        padded_vocab_size = -(-args.decoder_vocab_size // args.pad_vocab_multiple) * args.pad_vocab_multiple
+        model_decoder.resize_token_embeddings(padded_vocab_size)
+        model_decoder.lm_head.register_forward_hook(functools.partial(mask_padded_logits, args.decoder_vocab_size))
+    else:
+        model_decoder.resize_token_embeddings(args.decoder_vocab_size)  # Notice: resize_token_embeddings expect to receive the full size of the new vocabulary, i.e. the length of the tokenizer.
     assert tokenizer_decoder.pad_token == '<PAD>'
 
-    #model_decoder.to(args.device)
+    if args.grad_checkpoint:
+        # Recompute per-layer activations in backward (non-reentrant, so it composes with DDP's static graph)
+        model_encoder.gradient_checkpointing_enable()
+        model_decoder.gradient_checkpointing_enable()
 
-    model_vae = VAE(model_encoder, model_decoder, tokenizer_encoder, tokenizer_decoder, args).to(args.device) #
+    # The encoder and decoder are already on args.device and the VAE has no parameters of its own, so no extra .to() copy
+    model_vae = VAE(model_encoder, model_decoder, tokenizer_encoder, tokenizer_decoder, args)
     #model_vae.cuda()
     if args.use_random_weight:
         model_vae.apply(weights_init_rondom)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Compile the encoder and decoder in place (PyTorch >= 2.2), which keeps the state_dict keys unchanged. dynamic=True because
+    # bucketing changes the sequence length between batches. The VAE wrapper stays eager: it branches on args.fb_mode and
+    # reads a new beta float every step, both of which would trigger recompilation. Done before the DDP wrap.
+    # With --cuda_graph the compiled forward/backward are recorded into CUDA graphs once per distinct shape and then replayed,
+    # removing per-kernel launch overhead; the optimizer step and loss scaling stay outside the graphs.
+    if args.cuda_graph and (args.no_compile or not hasattr(torch.nn.Module, 'compile')):
+        raise ValueError("--cuda_graph requires torch.compile; drop --no_compile or upgrade to PyTorch >= 2.2.")
+    if not args.no_compile and hasattr(torch.nn.Module, 'compile'):
+        compile_mode = 'reduce-overhead' if args.cuda_graph else 'default'
+        model_vae.encoder.compile(dynamic=True, mode=compile_mode)
+        model_vae.decoder.compile(dynamic=True, mode=compile_mode)
+
+    # Distributed training
     if args.distributed:
-        # model_vae = torch.nn.parallel.DistributedDataParallel(model_vae, device_ids=gpus, output_device=args.local_rank, find_unused_parameters=True)
-        model_vae = torch.nn.parallel.DistributedDataParallel(model_vae, device_ids=gpus)
-    elif args.n_gpu > 1:
-        model_vae = torch.nn.DataParallel(model_vae)#.to(args.device)
+        # One device per process. Every fb_mode exercises the same parameters, so the autograd graph is static: the reducer
+        # registers its hooks once and overlaps bucketed all-reduces with backward; grads are views into the buckets (no copy).
+        model_vae = torch.nn.parallel.DistributedDataParallel(model_vae, device_ids=[gpus[0]], output_device=gpus[0], broadcast_buffers=False,
+                                                              bucket_cap_mb=50, gradient_as_bucket_view=True, static_graph=True)
 
     # on_gpu = next(model_vae.parameters()).is_cuda
 
@@ -758,12 +987,13 @@ def main():
         #if args.local_rank == 0: torch.distributed.barrier()
 
         global_step, tr_loss, optimizer = train(args, train_dataloader, model_vae, tokenizer_encoder, tokenizer_decoder, table_name)
-        logger.info("Rank %d, global_step = %s, average loss = %s", ompi_rank(), global_step, tr_loss)
+        logger.info("Rank %d, global_step = %s, average loss = %s", rank_node, global_step, tr_loss)
 
 
     # Saving best-practices: if you use save_pretrained for the model and tokenizer, you can reload them using from_pretrained()
     if args.do_train and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
         save_checkpoint(model_vae, optimizer, global_step, args)
+        wait_for_checkpoint()
 
 
 
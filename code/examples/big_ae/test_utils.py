@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils import BucketingMultipleFiles_DataLoader
+
+
+class DummyTokenizer(object):
+    pad_token = '<PAD>'
+    bos_token = '<BOS>'
+    eos_token = '<EOS>'
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def convert_tokens_to_ids(self, tokens):
+        return [self.pad_token_id for _ in tokens]
+
+
+class BucketingMultipleFilesDataLoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        # Two shards: iterating over the first one loads the next
+        for file_idx in range(2):
+            examples = [{'bert_token': list(range(1, length + 1)), 'gpt2_token': list(range(1, length + 3)),
+                         'bert_token_length': length, 'gpt2_token_length': length + 2}
+                        for length in [3, 5, 2, 7, 4, 6]]
+            with open(os.path.join(self.data_dir, 'debug.segmented.nltk.split.seq64.{}.json'.format(file_idx)), 'w') as f:
+                json.dump(examples, f)
+        self.tokenizers = [DummyTokenizer(0), DummyTokenizer(50257)]
+        self.args = argparse.Namespace(dataset='Debug', block_size=64, overwrite_cache=False, seed=42)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def build_loader(self, memmap_cache_dir=None):
+        return BucketingMultipleFiles_DataLoader(self.data_dir, 2, 64, self.tokenizers, self.args, bucket=3, shuffle=False,
+                                                 world_size=1, rank=0, memmap_cache_dir=memmap_cache_dir)
+
+    def test_json_shards(self):
+        loader = self.build_loader()
+        self.assertEqual(len(loader), 3)
+        batches = list(loader)
+        self.assertEqual(len(batches), 3)
+        for input_ids_bert, input_ids_gpt, token_lengths in batches:
+            self.assertEqual(input_ids_bert.shape[0], 2)
+            self.assertEqual(input_ids_bert.shape[1], token_lengths[:, 0].max().item())
+            self.assertEqual(input_ids_gpt.shape[1], token_lengths[:, 1].max().item())
+        self.assertEqual(loader.file_idx, 1)
+
+    def test_memmap_shards_match_json(self):
+        cache_dir = os.path.join(self.data_dir, 'cache')
+        json_batches = list(self.build_loader())
+        for _ in range(2):
+            # The second loader maps the cache built by the first one
+            memmap_batches = list(self.build_loader(memmap_cache_dir=cache_dir))
+            self.assertTrue(os.path.isdir(os.path.join(cache_dir, 'debug.segmented.nltk.split.seq64.0.json.memmap')))
+            self.assertEqual(len(memmap_batches), len(json_batches))
+            for memmap_batch, json_batch in zip(memmap_batches, json_batches):
+                for memmap_tensor, json_tensor in zip(memmap_batch, json_batch):
+                    self.assertTrue(memmap_tensor.equal(json_tensor))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,6 +14,7 @@ import torch.nn.init as init
 
 import glob
 import logging
+import shutil
 import pickle
 import random
 from torch.utils.data.distributed import DistributedSampler
@@ -118,6 +119,49 @@ class BucketSampler(Sampler):
             return sum(math.ceil(s/self._batch_size) for s in bucket_sizes)
 
 
+class DistributedBucketSampler(Sampler):
+    """BucketSampler for multi-process training: the per-rank batches of one step are cut from the same
+    length-sorted bucket, so every rank pads to a similar length and no rank waits on a much longer batch."""
+    def __init__(self, lens, bucket_size, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self._lens = lens
+        self._batch_size = batch_size
+        self._bucket_size = bucket_size
+        self._num_replicas = num_replicas
+        self._rank = rank
+        self._shuf = shuffle
+        self._seed = seed
+        self._epoch = 0
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+
+    def __iter__(self):
+        # All ranks share the generator state, so they agree on the buckets and on the order of the global batches
+        rng = random.Random(self._seed + self._epoch)
+        ids = list(range(len(self._lens)))
+        if self._shuf:
+            rng.shuffle(ids)
+        buckets = [sorted(ids[i:i+self._bucket_size],
+                          key=lambda i: self._lens[i], reverse=True)
+                   for i in range(0, len(ids), self._bucket_size)]
+        # Only full global batches are kept so that every rank runs the same number of steps
+        global_batch_size = self._batch_size * self._num_replicas
+        global_batches = [bucket[i:i+global_batch_size]
+                          for bucket in buckets
+                          for i in range(0, len(bucket) - global_batch_size + 1, global_batch_size)]
+        if self._shuf:
+            rng.shuffle(global_batches)
+        start = self._rank * self._batch_size
+        return iter([batch[start:start+self._batch_size] for batch in global_batches])
+
+    def __len__(self):
+        global_batch_size = self._batch_size * self._num_replicas
+        bucket_sizes = ([self._bucket_size]
+                        * (len(self._lens) // self._bucket_size)
+                        + [len(self._lens) % self._bucket_size])
+        return sum(s//global_batch_size for s in bucket_sizes)
+
+
 class FeatureDataset(Dataset):
     def __init__(self, features, max_len=None):
         self.features = features
@@ -237,7 +281,8 @@ class MultipleFiles_DataLoader(object):
 # When the dataset is too big, we can divide it into multiple small files.
 # This class is used load multiple files.
 class BucketingMultipleFiles_DataLoader(object):
-    def __init__(self, file_path, batch_size, max_seq_length, tokenizer, args, bucket=100, shuffle=True):
+    def __init__(self, file_path, batch_size, max_seq_length, tokenizer, args, bucket=100, shuffle=True, world_size=None, rank=None, worker_init_fn=None,
+                 memmap_cache_dir=None, num_workers=0):
 
         self.batch_size = batch_size
         self.max_len = max_seq_length
@@ -246,33 +291,66 @@ class BucketingMultipleFiles_DataLoader(object):
         self.file_path = file_path
         self.tokenizer = tokenizer
         self.args = args
+        # When world_size/rank are given, batches are bucketed by length consistently across ranks
+        self.world_size = world_size
+        self.rank = rank
+        self.num_passes = 0
+        self.worker_init_fn = worker_init_fn
+        # With a memmap_cache_dir the shards are read through MemmapTokenDataset, whose arrays workers share instead of copying.
+        # The directory must be writable by rank 0 and visible to every rank.
+        self.memmap_cache_dir = memmap_cache_dir
+        self.rebuilt_files = set()
+        self.num_workers = num_workers
 
         # prepare for the first file
         self.file_idx = 0
-        self.cached_features_file = os.path.join(self.file_path, args.dataset.lower()+f'.segmented.nltk.split.seq64.{self.file_idx}.json' )
-        self.dataset = PreparedTokenDataset(tokenizer, self.args, self.cached_features_file, block_size=self.args.block_size)
-        self.num_examples = len(self.dataset.examples)
-        self.num_batches = self.num_examples//batch_size
-        self.example_lengths = [example['bert_token_length'] for example in self.dataset.examples]
+        self.load_file()
 
+    def load_file(self):
+        self.cached_features_file = os.path.join(self.file_path, self.args.dataset.lower()+f'.segmented.nltk.split.seq64.{self.file_idx}.json' )
+        if self.memmap_cache_dir is not None:
+            memmap_dir = os.path.join(self.memmap_cache_dir, os.path.basename(self.cached_features_file) + '.memmap')
+            # --overwrite_cache rebuilds each shard on its first load of the run only, not on every pass
+            overwrite = self.args.overwrite_cache and self.file_idx not in self.rebuilt_files
+            self.rebuilt_files.add(self.file_idx)
+            # Rank 0 converts the shard while the others wait at the barrier, so nobody maps a directory that is being replaced
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            if not distributed or torch.distributed.get_rank() == 0:
+                MemmapTokenDataset.build_cache(self.cached_features_file, memmap_dir, overwrite=overwrite)
+            if distributed:
+                torch.distributed.barrier()
+            self.dataset = MemmapTokenDataset(self.tokenizer, memmap_dir)
+            self.example_lengths = self.dataset.token_lengths[:, 0].tolist()
+        else:
+            self.dataset = PreparedTokenDataset(self.tokenizer, self.args, self.cached_features_file, block_size=self.args.block_size)
+            self.example_lengths = [example['bert_token_length'] for example in self.dataset.examples]
+        self.num_examples = len(self.dataset)
+        self.num_batches = self.num_examples//self.batch_size
 
     def __iter__(self):
         
         # sampler = BucketSampler(self.example_lengths, self.bucket_size, self.batch_size, droplast=True, shuffle=self.shuffle)
         # loader = DataLoader(self.dataset, batch_sampler=sampler, num_workers=0, collate_fn=PreparedTokenDataset.collate)
 
+        loader_kwargs = dict(pin_memory=True, num_workers=self.num_workers, collate_fn=PreparedTokenDataset.collate, worker_init_fn=self.worker_init_fn)
+        if self.num_workers > 0:
+            loader_kwargs['prefetch_factor'] = 4
+
         # distributed
-        sampler = DistributedSampler(self.dataset)
-        loader = DataLoader(self.dataset, sampler=sampler, batch_size=self.batch_size, pin_memory=True, num_workers=0, collate_fn=PreparedTokenDataset.collate)
+        if self.world_size is None:
+            sampler = DistributedSampler(self.dataset)
+            loader = DataLoader(self.dataset, sampler=sampler, batch_size=self.batch_size, **loader_kwargs)
+        else:
+            sampler = DistributedBucketSampler(self.example_lengths, self.bucket_size * self.world_size, self.batch_size,
+                                               num_replicas=self.world_size, rank=self.rank, shuffle=self.shuffle, seed=self.args.seed)
+            sampler.set_epoch(self.num_passes)
+            loader = DataLoader(self.dataset, batch_sampler=sampler, **loader_kwargs)
+        self.num_passes += 1
         yield from loader
 
         # update file name for next file
         self.file_idx += 1
-        self.cached_features_file = os.path.join(self.file_path, self.args.dataset.lower()+f'.segmented.nltk.split.seq64.{self.file_idx}.json' )
-        self.dataset = PreparedTokenDataset(self.tokenizer, self.args, self.cached_features_file, block_size=self.args.block_size)
-        self.num_examples = len(self.dataset.examples)
-        self.num_batches = self.num_examples//self.batch_size
-        self.example_lengths = [example['bert_token_length'] for example in self.dataset.examples]
+        self.load_file()
 
 
     def __len__(self):
@@ -339,6 +417,64 @@ class PreparedTokenDataset(Dataset):
         return (input_ids_bert, input_ids_gpt, token_lengths)
 
 
+class MemmapTokenDataset(Dataset):
+    """ The examples of PreparedTokenDataset kept as flat token-id arrays plus offsets, memory-mapped from disk.
+    `build_cache` converts a JSON shard once into a `memmap_dir`; later passes and runs map the arrays instead of
+    parsing JSON, and DataLoader workers share the pages rather than copying a list of dicts. """
+    def __init__(self, tokenizers, memmap_dir):
+        assert os.path.isfile(os.path.join(memmap_dir, 'token_lengths.npy'))
+
+        global bert_pad_token
+        global gpt2_pad_token
+        bert_pad_token = tokenizers[0].convert_tokens_to_ids([tokenizers[0].pad_token])[0]
+        gpt2_pad_token = tokenizers[1].convert_tokens_to_ids([tokenizers[1].pad_token])[0]
+
+        logger.info("Loading features from memmap cache %s", memmap_dir)
+        self.bert_tokens = np.load(os.path.join(memmap_dir, 'bert_tokens.npy'), mmap_mode='r')
+        self.bert_offsets = np.load(os.path.join(memmap_dir, 'bert_offsets.npy'))
+        self.gpt2_tokens = np.load(os.path.join(memmap_dir, 'gpt2_tokens.npy'), mmap_mode='r')
+        self.gpt2_offsets = np.load(os.path.join(memmap_dir, 'gpt2_offsets.npy'))
+        self.token_lengths = np.load(os.path.join(memmap_dir, 'token_lengths.npy'))
+
+    @staticmethod
+    def build_cache(cached_features_file, memmap_dir, overwrite=False):
+        """ Convert `cached_features_file` into `memmap_dir` unless it is already there. Must run in a single process. """
+        assert os.path.isfile(cached_features_file)
+        if not overwrite and os.path.isfile(os.path.join(memmap_dir, 'token_lengths.npy')):
+            return
+
+        logger.info("Creating memmap cache %s for %s", memmap_dir, cached_features_file)
+        with open(cached_features_file, 'r') as handle:
+            examples = json.load(handle)
+
+        # Build in a temporary directory and rename it into place, so an interrupted build never looks complete
+        tmp_dir = '{}.tmp{}'.format(memmap_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        for key in ['bert', 'gpt2']:
+            seqs = [example[key + '_token'] for example in examples]
+            offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+            np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+            tokens = np.fromiter((t for seq in seqs for t in seq), dtype=np.int32, count=int(offsets[-1]))
+            np.save(os.path.join(tmp_dir, key + '_tokens.npy'), tokens)
+            np.save(os.path.join(tmp_dir, key + '_offsets.npy'), offsets)
+        token_lengths = np.array([[example['bert_token_length'], example['gpt2_token_length']] for example in examples], dtype=np.int64).reshape(-1, 2)
+        np.save(os.path.join(tmp_dir, 'token_lengths.npy'), token_lengths)
+
+        if os.path.isdir(memmap_dir):
+            shutil.rmtree(memmap_dir)
+        os.rename(tmp_dir, memmap_dir)
+
+    def __len__(self):
+        return len(self.token_lengths)
+
+    def __getitem__(self, item):
+        # same keys as the PreparedTokenDataset examples, so PreparedTokenDataset.collate handles both
+        return {'bert_token': self.bert_tokens[self.bert_offsets[item]:self.bert_offsets[item+1]],
+                'gpt2_token': self.gpt2_tokens[self.gpt2_offsets[item]:self.gpt2_offsets[item+1]],
+                'bert_token_length': int(self.token_lengths[item, 0]),
+                'gpt2_token_length': int(self.token_lengths[item, 1])}
+
+
 class TokenDataset(Dataset):
     def __init__(self, tokenizers, args, file_path='train', text_split_mode='natural', block_size=512):
 
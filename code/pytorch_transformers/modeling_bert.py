@@ -29,6 +29,7 @@ import pdb
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss
+from torch.utils.checkpoint import checkpoint
 
 from .modeling_utils import PreTrainedModel, prune_linear_layer
 from .configuration_bert import BertConfig
@@ -335,6 +336,7 @@ class BertEncoder(nn.Module):
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
         self.layer = nn.ModuleList([BertLayer(config) for _ in range(config.num_hidden_layers)])
+        self.gradient_checkpointing = False
 
     def forward(self, hidden_states, attention_mask, head_mask=None):
         all_hidden_states = ()
@@ -343,7 +345,10 @@ class BertEncoder(nn.Module):
             if self.output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
-            layer_outputs = layer_module(hidden_states, attention_mask, head_mask[i])
+            if self.gradient_checkpointing and self.training:
+                layer_outputs = checkpoint(layer_module, hidden_states, attention_mask, head_mask[i], use_reentrant=False)
+            else:
+                layer_outputs = layer_module(hidden_states, attention_mask, head_mask[i])
             hidden_states = layer_outputs[0]
 
             if self.output_attentions:
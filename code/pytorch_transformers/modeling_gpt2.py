@@ -31,6 +31,7 @@ import torch
 import torch.nn as nn
 from torch.nn import CrossEntropyLoss
 from torch.nn.parameter import Parameter
+from torch.utils.checkpoint import checkpoint
 
 from .modeling_utils import PreTrainedModel, Conv1D, prune_conv1d_layer, SequenceSummary
 from .configuration_gpt2 import GPT2Config
@@ -360,6 +361,7 @@ class GPT2Model(GPT2PreTrainedModel):
         self.drop = nn.Dropout(config.embd_pdrop)
         self.h = nn.ModuleList([Block(config.n_ctx, config, scale=True) for _ in range(config.n_layer)])
         self.ln_f = nn.LayerNorm(config.n_embd, eps=config.layer_norm_epsilon)
+        self.gradient_checkpointing = False
 
         try:
             self.latent_size = config.latent_size
@@ -483,10 +485,17 @@ class GPT2Model(GPT2PreTrainedModel):
                 all_hidden_states = all_hidden_states + (hidden_states.view(*output_shape),)
 
             
-            outputs = block(hidden_states,
-                            layer_past=layer_past,
-                            attention_mask=attention_mask,
-                            head_mask=head_mask[i])
+            if self.gradient_checkpointing and self.training:
+                outputs = checkpoint(block, hidden_states,
+                                     layer_past=layer_past,
+                                     attention_mask=attention_mask,
+                                     head_mask=head_mask[i],
+                                     use_reentrant=False)
+            else:
+                outputs = block(hidden_states,
+                                layer_past=layer_past,
+                                attention_mask=attention_mask,
+                                head_mask=head_mask[i])
 
             
             hidden_states, present = outputs[:2]
@@ -192,6 +192,15 @@ class PreTrainedModel(nn.Module):
 
         base_model._prune_heads(heads_to_prune)
 
+    def gradient_checkpointing_enable(self):
+        """ Activates gradient checkpointing: in training mode the activations of each transformer layer are
+            recomputed during the backward pass instead of being stored, trading extra compute for activation memory.
+            Only affects layer stacks that support it (``BertEncoder``, ``GPT2Model``).
+        """
+        for module in self.modules():
+            if hasattr(module, 'gradient_checkpointing'):
+                module.gradient_checkpointing = True
+
     def save_pretrained(self, save_directory):
         """ Save a model and its configuration file to a directory, so that it
             can be re-loaded using the `:func:`~pytorch_transformers.PreTrainedModel.from_pretrained`` class method.
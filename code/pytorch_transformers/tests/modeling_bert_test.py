@@ -35,6 +35,7 @@ class BertModelTest(CommonTestCases.CommonModelTester):
     all_model_classes = (BertModel, BertForMaskedLM, BertForNextSentencePrediction,
             BertForPreTraining, BertForQuestionAnswering, BertForSequenceClassification,
             BertForTokenClassification)
+    test_gradient_checkpointing_supported = True
 
     class BertModelTester(object):
 
@@ -50,6 +50,7 @@ class CommonTestCases:
         test_pruning = True
         test_resize_embeddings = True
         test_head_masking = True
+        test_gradient_checkpointing_supported = False
 
         def test_initialization(self):
             config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()
@@ -370,6 +371,46 @@ class CommonTestCases:
                     list(hidden_states[0].shape[-2:]),
                     [self.model_tester.seq_length, self.model_tester.hidden_size])
 
+        def test_gradient_checkpointing(self):
+            if not self.test_gradient_checkpointing_supported:
+                return
+
+            config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()
+
+            for model_class in self.all_model_classes:
+                model = model_class(config)
+                model.train()
+                model_checkpointed = copy.deepcopy(model)
+                model_checkpointed.gradient_checkpointing_enable()
+                self.assertTrue(any(getattr(module, 'gradient_checkpointing', False) for module in model_checkpointed.modules()))
+
+                forward_calls = []
+                def run_forward_backward(model):
+                    hooks = [module.register_forward_hook(lambda *_: forward_calls.append(1)) for module in model.modules()]
+                    del forward_calls[:]
+                    # Checkpointing replays the dropout RNG state, so both models see the same masks
+                    torch.manual_seed(0)
+                    outputs = model(**inputs_dict)[0]
+                    # Some heads of this fork nest their first output in a tuple
+                    while isinstance(outputs, (tuple, list)):
+                        outputs = outputs[0]
+                    outputs.sum().backward()
+                    for hook in hooks:
+                        hook.remove()
+                    return outputs, len(forward_calls)
+
+                outputs, num_forward_calls = run_forward_backward(model)
+                outputs_checkpointed, num_forward_calls_checkpointed = run_forward_backward(model_checkpointed)
+
+                # The checkpointed layers are run again during backward
+                self.assertGreater(num_forward_calls_checkpointed, num_forward_calls)
+                self.assertTrue(torch.allclose(outputs, outputs_checkpointed, atol=1e-5))
+                for (name, param), (_, param_checkpointed) in zip(model.named_parameters(), model_checkpointed.named_parameters()):
+                    if param.grad is None:
+                        self.assertIsNone(param_checkpointed.grad, msg=name)
+                    else:
+                        self.assertTrue(torch.allclose(param.grad, param_checkpointed.grad, atol=1e-5), msg=name)
+
         def test_resize_tokens_embeddings(self):
             original_config, inputs_dict = self.model_tester.prepare_config_and_inputs_for_common()
             if not self.test_resize_embeddings:
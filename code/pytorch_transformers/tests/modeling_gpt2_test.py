@@ -31,6 +31,7 @@ from .configuration_common_test import ConfigTester
 class GPT2ModelTest(CommonTestCases.CommonModelTester):
 
     all_model_classes = (GPT2Model, GPT2LMHeadModel, GPT2DoubleHeadsModel)
+    test_gradient_checkpointing_supported = True
 
     class GPT2ModelTester(object):
 
@@ -31,6 +31,7 @@ from .configuration_common_test import ConfigTester
 class RobertaModelTest(CommonTestCases.CommonModelTester):
 
     all_model_classes = (RobertaForMaskedLM, RobertaModel)
+    test_gradient_checkpointing_supported = True
 
     class RobertaModelTester(object):
 